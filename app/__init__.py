@@ -1,18 +1,32 @@
 # app/__init__.py
 import logging
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 import threading
+import itertools
 import os
+from app.utils import find_last_capture_id
+
+try: # Optional: C-accelerated JSON for jsonify(); falls back to the stdlib encoder
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- Global variable and lock for thread safety (for mDNS discovered info) ---
 esp32_service_info = {
-    "url": None, "ip": None, "port": None, "last_seen": 0
+    "url": None, "ip": None, "port": None, "last_seen": 0, "ttl": 0 # last_seen is time.monotonic()
 }
 esp32_service_info_lock = threading.Lock()
+# Immutable (url, ip, port) tuple, or None, in a single-slot list. It is replaced only
+# when the target changes; last_seen/ttl renewals are in esp32_service_info only.
+# Writers replace the tuple under esp32_service_info_lock; readers take
+# esp32_service_snapshot[0] without locking (a single reference load).
+esp32_service_snapshot = [None]
 
-# --- RPi-side Image ID Counter ---
-rpi_image_id_counter = 0
-rpi_image_id_counter_lock = threading.Lock()
+# --- RPi-side Image ID Counter --- (created below, once the upload folder is known)
+rpi_image_id_counter = None
+next_rpi_image_id = None
+upload_dir_fd = None # Open descriptor of the upload folder, for os.open(..., dir_fd=)
 
 # --- mDNS Thread Management ---
 mdns_thread_instance = None
@@ -22,10 +36,28 @@ mdns_thread_stop_event = threading.Event() # This will be passed to the thread
 app_flask_instance = Flask(__name__) # Can be 'app' or any other name, this is the instance.
                                    # Let's stick with app_flask_instance for clarity.
 
+if orjson is not None:
+    class ORJSONProvider(DefaultJSONProvider):
+        """jsonify()/request.get_json() through orjson. Output is always compact."""
+        # Dates go through self.default (HTTP-date, as with the stdlib provider) and
+        # non-str dict keys are stringified instead of raising
+        _OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+        def dumps(self, obj, **kwargs):
+            option = self._OPTIONS | orjson.OPT_SORT_KEYS if self.sort_keys else self._OPTIONS
+            return orjson.dumps(obj, default=self.default, option=option).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app_flask_instance.json = ORJSONProvider(app_flask_instance)
+
 # Configure basic logging (can be done before or after app creation)
 # If using app.logger, do it after app_flask_instance is created.
 # For global logging.basicConfig, order is less critical.
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Only configure the root logger once, so re-imports never stack duplicate handlers.
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__) # Logger for this __init__ module
 
 # --- Configuration for Flask app ---
@@ -34,7 +66,25 @@ PROJECT_ROOT = os.path.dirname(APP_ROOT)
 # Update the upload folder to point to 'output/uploads'
 app_flask_instance.config['UPLOAD_FOLDER'] = os.path.join(PROJECT_ROOT, 'output', 'uploads')
 os.makedirs(app_flask_instance.config['UPLOAD_FOLDER'], exist_ok=True)
-logger.info(f"Upload folder set to: {app_flask_instance.config['UPLOAD_FOLDER']}")
+# Captures are created relative to this descriptor, so the kernel doesn't walk the full
+# upload path on every save. Opened in each gunicorn worker (see gunicorn.conf.py).
+if os.open in os.supports_dir_fd:
+    upload_dir_fd = os.open(app_flask_instance.config['UPLOAD_FOLDER'], os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+# Continue numbering after the captures already on disk; the ID is the filename key.
+# count.__next__ runs as a single C call under the GIL, so no lock is needed.
+rpi_image_id_counter = itertools.count(find_last_capture_id(app_flask_instance.config['UPLOAD_FOLDER']) + 1)
+next_rpi_image_id = rpi_image_id_counter.__next__
+# Set to True when running behind a server that honors X-Sendfile (Apache mod_xsendfile,
+# lighttpd) so captured images are sent by the front server instead of Python.
+app_flask_instance.config['USE_X_SENDFILE'] = False
+# Set to an internal nginx location (e.g. '/internal-uploads/') to serve captures via
+# X-Accel-Redirect, with nginx configured as:
+#     location /internal-uploads/ { internal; alias <UPLOAD_FOLDER>/; sendfile on; tcp_nopush on; }
+# None keeps serving them from Python with send_from_directory.
+app_flask_instance.config['X_ACCEL_REDIRECT_PREFIX'] = None
+# Templates don't change while the app runs; skip the per-render mtime check on the template file
+app_flask_instance.config['TEMPLATES_AUTO_RELOAD'] = False
+logger.info("Upload folder set to: %s", app_flask_instance.config['UPLOAD_FOLDER'])
 
 # --- Import other app modules AFTER app_flask_instance is defined ---
 # These modules might import 'app_flask_instance' from 'app' (this file)
@@ -49,23 +99,32 @@ log_manager.init_logging(app_flask_instance.config['UPLOAD_FOLDER'])
 # The start_mdns_and_app and shutdown_app can remain here or move to run.py if preferred
 # For simplicity, let's keep them here for now.
 
-def start_mdns_and_app_thread_safe(host='0.0.0.0', port=5000, debug=False): # Renamed for clarity
+def start_mdns_thread():
+    """
+    Starts the mDNS discovery thread if it isn't running. Under gunicorn this is
+    called from the worker's post_fork hook (see gunicorn.conf.py), never at import.
+    """
     global mdns_thread_instance # Ensure we're modifying the package-level global
-    
+
     logger.info("Attempting to start mDNS discovery thread...")
     if not mdns_thread_instance or not mdns_thread_instance.is_alive():
         # Pass the shared data structures and stop event to the thread target
         mdns_thread_instance = threading.Thread(
             target=mdns_discover.mdns_browser_thread_target_stoppable, 
-            args=(mdns_thread_stop_event, esp32_service_info, esp32_service_info_lock), 
+            args=(mdns_thread_stop_event, esp32_service_info, esp32_service_info_lock,
+                  esp32_service_snapshot, log_manager.set_writer_loop), # CSV writes share its loop
             daemon=True
         )
         mdns_thread_instance.start()
         logger.info("mDNS discovery thread successfully started.")
     else:
         logger.info("mDNS discovery thread already running.")
-    
-    logger.info(f"Starting Flask web server on {host}:{port}...")
+
+def start_mdns_and_app_thread_safe(host='0.0.0.0', port=5000, debug=False): # Renamed for clarity
+    """Development entry point: mDNS thread plus Flask's built-in server. Use wsgi.py in production."""
+    start_mdns_thread()
+
+    logger.info("Starting Flask web server on %s:%s...", host, port)
     try:
         # Note: Flask's app.run() is blocking. It will only return when the server stops.
         app_flask_instance.run(host=host, port=port, debug=debug, use_reloader=False)
@@ -79,6 +138,7 @@ def shutdown_app_resources(): # Renamed for clarity
     logger.info("Initiating application resource shutdown (mDNS thread)...")
     if mdns_thread_instance and mdns_thread_instance.is_alive():
         mdns_thread_stop_event.set() # Signal the thread to stop
+        mdns_discover.wake_mdns_thread() # Release its event loop so it sees the signal
         mdns_thread_instance.join(timeout=5) # Wait for thread to finish
         if mdns_thread_instance.is_alive():
             logger.warning("mDNS thread did not exit cleanly within timeout.")
@@ -87,4 +147,5 @@ def shutdown_app_resources(): # Renamed for clarity
     else:
         logger.info("mDNS thread was not running or already stopped.")
     mdns_thread_instance = None # Clear the instance
+    log_manager.shutdown_logging() # Flush queued CSV rows and close the log file
     logger.info("Application resource cleanup complete.")
\ No newline at end of file
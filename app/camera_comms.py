@@ -1,44 +1,64 @@
 # app/camera_comms.py
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 import time # For timing the fetch
 
 logger = logging.getLogger(__name__)
 
+# (connect, read) timeouts in seconds. Both are short so a dead or moved ESP32
+# fails fast and triggers an immediate mDNS re-resolve instead of stalling the request.
+ESP32_FETCH_TIMEOUT = (1, 5)
+
+# Persistent session so captures reuse the TCP connection to the ESP32 (keep-alive)
+_session = requests.Session()
+_session.headers['Connection'] = 'keep-alive'
+# One host (the ESP32), which serves one capture at a time. No transparent retries:
+# a failed capture is reported and re-resolved instead of being silently repeated.
+_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0))
+
+def reset_esp32_connections():
+    """Drops pooled keep-alive connections, e.g. after the ESP32 became unreachable or moved."""
+    _session.close() # The session stays usable; the next request opens a fresh connection
+
 def fetch_image_from_esp32(capture_url):
     """
-    Fetches an image from the ESP32.
-    Returns a tuple (image_data, content_type, error_message, status_code, fetch_duration_ms)
-    error_message is None on success. status_code is HTTP status.
+    Requests an image from the ESP32 without reading the body into memory.
+    Returns a tuple (response, content_type, error_message, status_code, fetch_duration_ms)
+    On success, response is a streaming requests.Response whose body the caller must
+    consume (e.g. from response.raw) and then close. error_message is None on success.
+    fetch_duration_ms measures the time until the response headers arrived.
     """
     if not capture_url:
         return None, None, "ESP32 capture URL is not known.", 503, 0
 
     try:
         start_time = time.monotonic()
-        logger.info(f"Requesting image from ESP32: {capture_url}")
-        response = requests.get(capture_url, timeout=20) # 20-second timeout
+        logger.info("Requesting image from ESP32: %s", capture_url)
+        response = _session.get(capture_url, stream=True, timeout=ESP32_FETCH_TIMEOUT)
         duration_ms = (time.monotonic() - start_time) * 1000
-        
+
         response.raise_for_status() # Raises HTTPError for 4xx/5xx status
 
-        image_data = response.content
         content_type = response.headers.get('Content-Type', '').lower()
-        
-        if not image_data:
-            logger.error("ESP32 returned empty image data.")
-            return None, content_type, "ESP32 returned empty image data", response.status_code, duration_ms
-            
-        logger.info(f"Received {len(image_data)} bytes from ESP32 (Content-Type: {content_type}) in {duration_ms:.2f} ms.")
-        return image_data, content_type, None, response.status_code, duration_ms
-
-    except requests.exceptions.Timeout:
+        response.raw.decode_content = True # Let urllib3 undo any Content-Encoding while streaming
+
+        logger.info("Receiving image from ESP32 (Content-Type: %s), headers after %.2f ms.", content_type, duration_ms)
+        return response, content_type, None, response.status_code, duration_ms
+
+    except requests.exceptions.ConnectTimeout:
+        # Also a ConnectionError, and the usual symptom of a dead or moved ESP32 (no SYN-ACK):
+        # reported as 502 so the route drops the address and re-resolves it
         logger.error(f"Timeout connecting to ESP32 at {capture_url}")
+        return None, None, "Connection Error: ESP32 camera did not accept the connection.", 502, (time.monotonic() - start_time) * 1000
+    except requests.exceptions.Timeout: # ReadTimeout: connected, but no response in time
+        logger.error(f"Timeout waiting for ESP32 response from {capture_url}")
         return None, None, "Timeout: ESP32 camera did not respond.", 504, (time.monotonic() - start_time) * 1000
     except requests.exceptions.ConnectionError:
         logger.error(f"Connection error to ESP32 at {capture_url}")
         return None, None, "Connection Error: Could not connect to ESP32 camera.", 502, (time.monotonic() - start_time) * 1000
     except requests.exceptions.HTTPError as e:
+        # Error bodies are small; reading .text consumes the stream and frees the connection
         logger.error(f"HTTP error from ESP32: {e.response.status_code} - {e.response.text}")
         return None, None, f"ESP32 Error: {e.response.status_code} - {e.response.text}", e.response.status_code, (time.monotonic() - start_time) * 1000
     except Exception as e:
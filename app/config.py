@@ -0,0 +1,10 @@
+# app/config.py
+# Constants shared by several app modules. Depends on nothing else in the app,
+# so any module can import it at the top level without import cycles.
+
+# --- mDNS Configuration ---
+ESP32_MDNS_HOSTNAME_BASE = "my-esp32-cam"
+ESP32_SERVICE_TYPE = "_http._tcp.local."
+# The ESP32 mDNS responder names its service instance after its hostname, so the
+# target can be resolved directly instead of browsing every _http._tcp service on the LAN.
+ESP32_SERVICE_NAME = f"{ESP32_MDNS_HOSTNAME_BASE}.{ESP32_SERVICE_TYPE}"
@@ -1,9 +1,11 @@
 # app/log_manager.py
+import atexit
 import csv
 import os
 import logging
+import queue
 from threading import Lock # For thread-safe file writing
-from datetime import datetime # For ISO timestamp formatting
+from app.utils import iso_timestamp_from_ns # For ISO timestamp formatting
 
 logger = logging.getLogger(__name__)
 
@@ -19,47 +21,120 @@ CSV_HEADER = [
 ]
 
 _log_file_lock = Lock() # To prevent concurrent writes to the CSV
+_log_fh = None # Append-mode CSV handle kept open for the app's lifetime
+_log_writer = None
+
+# Rows are queued by request threads and written in batches on the app's background
+# event loop (the mDNS thread), so requests never block on disk I/O.
+LOG_BATCH_MAX_ROWS = 64 # Max rows written per writerows() call
+LOG_QUEUE_MAX_ROWS = 1024 # Rows beyond this are dropped rather than stalling a capture
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_MAX_ROWS)
+_writer_loop = None # asyncio loop that runs the CSV writes; None means write inline
 
 def init_logging(upload_folder_path):
     """
     Initializes the logging system, creating the log file and writing headers if needed.
     Should be called once when the Flask app starts.
     """
-    global LOG_FILE_PATH
+    global LOG_FILE_PATH, _log_fh, _log_writer
     # Place log file in the 'output' directory within the project root
     LOG_FILE_PATH = os.path.join(os.path.dirname(upload_folder_path), LOG_FILE_NAME)
     
-    logger.info(f"Image capture log will be saved to: {LOG_FILE_PATH}")
+    logger.info("Image capture log will be saved to: %s", LOG_FILE_PATH)
 
     with _log_file_lock:
         try:
-            # Check if file exists to avoid writing headers multiple times
-            file_exists = os.path.isfile(LOG_FILE_PATH)
-            
-            # Open in append mode ('a'), create if not exists ('+'), newline='' for csv
-            with open(LOG_FILE_PATH, mode='a+', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                if not file_exists or os.path.getsize(LOG_FILE_PATH) == 0:
-                    writer.writerow(CSV_HEADER)
-                    logger.info(f"CSV log header written to {LOG_FILE_PATH}")
+            # Open once in append mode, newline='' for csv. Line buffering pushes each
+            # row to the OS as it is written without paying for an fsync.
+            _log_fh = open(LOG_FILE_PATH, mode='a', newline='', buffering=1)
+            _log_writer = csv.writer(_log_fh)
+            # A single fstat on the open handle covers both "new file" and "empty
+            # file", so the header is written exactly once.
+            if os.fstat(_log_fh.fileno()).st_size == 0:
+                _log_writer.writerow(CSV_HEADER)
+                logger.info("CSV log header written to %s", LOG_FILE_PATH)
         except IOError as e:
             logger.error(f"Error initializing log file {LOG_FILE_PATH}: {e}")
+            return
+
+    atexit.register(shutdown_logging)
 
 
-def log_capture_event(rpi_datetime_obj, rpi_image_id, saved_filename, 
-                      image_size_bytes, fetch_duration_ms, esp32_url_used): # Changed first arg
+def set_writer_loop(loop):
     """
-    Logs a single image capture event to the CSV file.
+    Hands CSV writes to `loop` (called from that loop's thread when it starts), or back
+    to the calling thread when `loop` is None (called as the loop exits).
     """
-    if LOG_FILE_PATH is None:
-        logger.error("Log file path not initialized. Call init_logging first.")
-        return
+    global _writer_loop
+    _writer_loop = loop
+    if loop is None:
+        _write_queued_rows() # Rows queued after the loop's last write
+
+
+def _write_queued_rows():
+    """
+    Writes every queued row to the CSV, LOG_BATCH_MAX_ROWS per writerows() call,
+    then flushes once. A burst of captures therefore shares a single write+flush.
+    """
+    with _log_file_lock:
+        if _log_writer is None:
+            return
+        total = 0
+        while True:
+            batch = []
+            try:
+                while len(batch) < LOG_BATCH_MAX_ROWS:
+                    batch.append(_log_queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not batch:
+                break
+            for row in batch:
+                # Rows carry the raw time.time_ns() value; format it here, off the request path
+                if row[0] is not None:
+                    row[0] = iso_timestamp_from_ns(row[0])
+                else:
+                    row[0] = "N/A"
+            try:
+                _log_writer.writerows(batch)
+                total += len(batch)
+            except IOError as e:
+                logger.error(f"Error writing to log file {LOG_FILE_PATH}: {e}")
+            except Exception as e:
+                logger.error(f"Unexpected error during CSV logging: {e}", exc_info=True)
+        if total:
+            try:
+                _log_fh.flush()
+            except IOError as e:
+                logger.error(f"Error flushing log file {LOG_FILE_PATH}: {e}")
+            logger.debug("Logged %d event(s) to CSV.", total)
+
+
+def shutdown_logging():
+    """
+    Writes any queued rows and closes the CSV file. Safe to call more than once.
+    """
+    global _writer_loop, _log_fh, _log_writer
+    _writer_loop = None
+    _write_queued_rows()
+    with _log_file_lock:
+        if _log_fh is not None:
+            _log_fh.close()
+        _log_fh = None
+        _log_writer = None
+
 
-    # Format the datetime object to ISO 8601 string for consistent logging
-    rpi_iso_timestamp_str = rpi_datetime_obj.isoformat() if rpi_datetime_obj else "N/A"
+def log_capture_event(rpi_timestamp_ns, rpi_image_id, saved_filename,
+                      image_size_bytes, fetch_duration_ms, esp32_url_used):
+    """
+    Queues a single image capture event for the CSV writer.
+    """
+    if _log_writer is None:
+        logger.error("Log file not initialized. Call init_logging first.")
+        return
 
     log_row = [
-        rpi_iso_timestamp_str, # Use ISO formatted timestamp
+        rpi_timestamp_ns, # time.time_ns(); written as an ISO 8601 string by the writer
         rpi_image_id,
         saved_filename,
         image_size_bytes,
@@ -67,14 +142,18 @@ def log_capture_event(rpi_datetime_obj, rpi_image_id, saved_filename,
         esp32_url_used
     ]
 
-    with _log_file_lock:
-        try:
-            with open(LOG_FILE_PATH, mode='a', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(log_row)
-            # Use a more concise debug log here, as the full row can be long
-            logger.debug(f"Logged event to CSV for image ID: {rpi_image_id}") 
-        except IOError as e:
-            logger.error(f"Error writing to log file {LOG_FILE_PATH}: {e}")
-        except Exception as e:
-            logger.error(f"Unexpected error during CSV logging: {e}", exc_info=True)
\ No newline at end of file
+    try:
+        _log_queue.put_nowait(log_row)
+    except queue.Full:
+        # The writer has fallen far behind (e.g. a stalled SD card); never block the request
+        logger.warning(f"CSV log queue full; dropped event for image ID: {rpi_image_id}")
+        return
+    loop = _writer_loop
+    if loop is None:
+        _write_queued_rows() # No background loop running (e.g. app not started via run.py)
+        return
+    try:
+        # Non-blocking; one callback drains every row queued before it runs
+        loop.call_soon_threadsafe(_write_queued_rows)
+    except RuntimeError: # Loop closed between the check and the call
+        _write_queued_rows()
@@ -1,108 +1,196 @@
+import asyncio
 import logging
-import socket
+import random
 import time
-from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo, BadTypeInNameException
-import threading
+from zeroconf import DNSQuestionType, IPVersion, current_time_millis
+from zeroconf.asyncio import AsyncZeroconf, AsyncServiceInfo
+from zeroconf.const import _CLASS_IN, _TYPE_A, _TYPE_SRV
+from app.config import ESP32_SERVICE_TYPE, ESP32_SERVICE_NAME
+from app.utils import MDNS_CPU_CORES, pin_current_thread_to_cores
 
 logger = logging.getLogger(__name__)
 
-# --- mDNS Configuration --- (Can be moved to a config module later)
-ESP32_MDNS_HOSTNAME_BASE = "my-esp32-cam"
-ESP32_SERVICE_TYPE = "_http._tcp.local."
+RESOLVE_TIMEOUT_MS = 800 # Responders on the LAN answer well within this; only a missing ESP32 waits it out
+# The resolved records are treated as valid for their TTL; the next resolve is
+# scheduled just after they expire from Zeroconf's cache so it goes to the network.
+DEFAULT_RECORD_TTL_S = 120 # RFC 6762 host record TTL, used if the cache has no TTL
+RESOLVE_REFRESH_MIN_S = 1
+RESOLVE_RETRY_MIN_S = 1 # First retry delay after a failed resolve; doubles up to the max
+RESOLVE_RETRY_MAX_S = 30
 
-class ESP32Listener:
-    def __init__(self, target_hostname_base, service_info_dict, service_info_lock):
-        self.target_hostname_base = target_hostname_base.lower()
+def _jittered(delay_s):
+    """Spreads a delay over [delay/2, delay] so retries from many clients don't align."""
+    return delay_s / 2 + random.uniform(0, delay_s / 2)
+
+def _cached_target_records(zeroconf, service_name, server):
+    """The target's SRV record and its server's A records currently in Zeroconf's cache."""
+    records = list(zeroconf.cache.async_all_by_details(service_name, _TYPE_SRV, _CLASS_IN))
+    if server:
+        records += zeroconf.cache.async_all_by_details(server, _TYPE_A, _CLASS_IN)
+    return records
+
+def _remaining_record_ttl_s(zeroconf, service_name, server):
+    """Seconds until the first of the target's SRV/A records expires from Zeroconf's cache."""
+    now = current_time_millis()
+    records = _cached_target_records(zeroconf, service_name, server)
+    if not records:
+        return DEFAULT_RECORD_TTL_S
+    return min(record.get_remaining_ttl(now) for record in records)
+
+class ESP32Resolver:
+    def __init__(self, service_name, service_info_dict, service_info_lock, service_snapshot):
+        self.service_name = service_name
         self.service_info_dict = service_info_dict # Reference to the global dict
         self.service_info_lock = service_info_lock # Reference to its lock
-        logger.info(f"mDNS Listener initialized for hostname base: '{self.target_hostname_base}'")
+        self.service_snapshot = service_snapshot # Single-slot list read lock-free by routes
+        self.server = None # Host name from the last successful resolve, e.g. 'my-esp32-cam.local.'
+        # Packed IPv4 address and port behind the published URL; repeat answers are compared
+        # against these so the URL and snapshot are only rebuilt when the target moves
+        self._last_address = None
+        self._last_port = None
+        logger.info("mDNS Resolver initialized for service: '%s'", self.service_name)
 
-    def _update_esp32_info(self, ip_address, port, service_name=""):
+    def _update_esp32_info(self, address, port, ttl_s, service_name=""):
         with self.service_info_lock:
+            now = time.monotonic() # Immune to wall-clock jumps
+            # Same target still published (routes may have cleared it after a failure): just renew it
+            if address == self._last_address and port == self._last_port and self.service_snapshot[0] is not None:
+                logger.debug("mDNS: TARGET ESP32 '%s' unchanged at %s", service_name, self.service_info_dict["url"])
+                self.service_info_dict["last_seen"] = now
+                self.service_info_dict["ttl"] = ttl_s
+                return
+            ip_address = f"{address[0]}.{address[1]}.{address[2]}.{address[3]}"
             new_url = f"http://{ip_address}:{port}/capture"
+            logger.debug("mDNS: Resolved TARGET ESP32 '%s' (Server: %s) at %s:%s",
+                         service_name, self.server, ip_address, port)
             if self.service_info_dict.get("url") != new_url:
-                logger.info(
-                    f"mDNS: Updating ESP32 info. URL: {new_url} for service '{service_name}'"
-                )
+                logger.info("mDNS: Updating ESP32 info. URL: %s for service '%s'", new_url, service_name)
             self.service_info_dict["ip"] = ip_address
             self.service_info_dict["port"] = port
             self.service_info_dict["url"] = new_url
-            self.service_info_dict["last_seen"] = time.time()
-
-    def remove_service(self, zeroconf_instance, type, name):
-        logger.info(f"mDNS: Service {name} removed.")
-        if self.target_hostname_base in name.lower():
-            logger.warning(f"mDNS: A service potentially matching target ('{name}') removed.")
-            with self.service_info_lock:
-                # Check if it was indeed our currently known service
-                current_ip = self.service_info_dict.get("ip")
-                info_to_check = None
-                try:
-                    info_to_check = zeroconf_instance.get_service_info(type, name, timeout=500) # Quick check if still resolvable
-                except: pass
-
-                # A more reliable way to check if it's "ours" is if the name itself was stored.
-                # Or, if the ip/port matched.
-                # For now, let's assume if a service with target_hostname_base in its name is removed,
-                # we should clear our cached info.
-                # This might lead to brief unavailability if other unrelated services with similar names exist.
-                self.service_info_dict["url"] = None
-                self.service_info_dict["ip"] = None
-                self.service_info_dict["port"] = None
-
-
-    def add_service(self, zeroconf_instance, type, name):
-        info = None
+            self.service_info_dict["last_seen"] = now
+            self.service_info_dict["ttl"] = ttl_s
+            # Publish with a single store; readers never see a half-updated entry
+            self.service_snapshot[0] = (new_url, ip_address, port)
+            self._last_address, self._last_port = address, port
+
+    def _clear_esp32_info(self):
+        with self.service_info_lock:
+            if self.service_info_dict.get("url") is not None:
+                logger.warning(f"mDNS: Target service '{self.service_name}' no longer resolvable. Clearing cached info.")
+            self.service_info_dict["url"] = None
+            self.service_info_dict["ip"] = None
+            self.service_info_dict["port"] = None
+            self.service_snapshot[0] = None
+            self._last_address = self._last_port = None
+
+    async def async_resolve(self, zeroconf, bypass_cache=False):
+        """
+        Resolves the target service once.
+        With bypass_cache, the cached records are dropped first so the answer comes from the
+        ESP32 itself (used when the cached address just failed).
+        Returns the remaining TTL in seconds of the resolved records, or None on failure.
+        """
+        if bypass_cache:
+            zeroconf.cache.async_remove_records(_cached_target_records(zeroconf, self.service_name, self.server))
+        info = AsyncServiceInfo(ESP32_SERVICE_TYPE, self.service_name)
         try:
-            info = zeroconf_instance.get_service_info(type, name, timeout=2000)
-        except BadTypeInNameException:
-            logger.debug(f"mDNS: Ignoring service with bad type: {name}")
-            return
+            # Answered straight from Zeroconf's cache while the records are still valid.
+            # Otherwise ask for a unicast (QU) reply, which responders send immediately
+            # instead of delaying it to aggregate multicast answers.
+            found = await info.async_request(zeroconf, RESOLVE_TIMEOUT_MS,
+                                             question_type=DNSQuestionType.QU)
         except Exception as e:
-            logger.warning(f"mDNS: Could not get info for service {name}: {e}")
-            return
-
-        if info and info.server and info.addresses and info.port is not None:
-            discovered_hostname_base = info.server.split('.')[0].lower()
-            if discovered_hostname_base == self.target_hostname_base:
-                ip_address_str = socket.inet_ntoa(info.addresses[0])
-                port = info.port
-                logger.info(f"mDNS: Discovered TARGET ESP32 '{name}' (Server: {info.server}) at {ip_address_str}:{port}")
-                self._update_esp32_info(ip_address_str, port, name)
-
-    def update_service(self, zeroconf_instance, type, name):
-        logger.debug(f"mDNS: Service {name} updated. Re-processing.")
-        self.add_service(zeroconf_instance, type, name)
-
-# Global Zeroconf instances for the thread
-_zc_instance_thread = None
-_browser_instance_thread = None
-
-def mdns_browser_thread_target_stoppable(stop_event, service_info_dict_ref, service_info_lock_ref):
-    global _zc_instance_thread, _browser_instance_thread
-    
-    # Make the current thread know about its stop_event for cleaner checking
-    threading.current_thread().stop_event = stop_event
+            logger.warning(f"mDNS: Could not get info for service {self.service_name}: {e}")
+            found = False
+
+        # IPv4 only: on dual-stack LANs addresses[0] may be a 16-byte IPv6 address.
+        # Kept packed (4 bytes); it is only formatted when the published URL changes.
+        ipv4_addresses = info.addresses_by_version(IPVersion.V4Only) if found else []
+        if ipv4_addresses and info.port is not None:
+            address = ipv4_addresses[0]
+            port = info.port
+            self.server = info.server
+            ttl_s = _remaining_record_ttl_s(zeroconf, self.service_name, info.server)
+            self._update_esp32_info(address, port, ttl_s, self.service_name)
+            return ttl_s
+
+        self._clear_esp32_info()
+        return None
+
+# Event loop of the mDNS thread and the asyncio event used to wake it early
+_mdns_loop = None
+_mdns_wake_event = None
+_mdns_refresh_requested = False # Set with a wake when the cached address stopped working
 
+async def _async_resolve_until_stopped(stop_event, resolver, on_loop_change):
+    global _mdns_loop, _mdns_wake_event, _mdns_refresh_requested
+    # Created before the loop is published: if this raises (e.g. no usable network
+    # interface), nothing is left pointing at a loop that is about to close
+    aiozc = AsyncZeroconf()
     try:
-        listener = ESP32Listener(ESP32_MDNS_HOSTNAME_BASE, service_info_dict_ref, service_info_lock_ref)
-        _zc_instance_thread = Zeroconf()
-        logger.info(f"mDNS Thread: Starting browser for '{ESP32_SERVICE_TYPE}' (target: {ESP32_MDNS_HOSTNAME_BASE})...")
-        _browser_instance_thread = ServiceBrowser(_zc_instance_thread, ESP32_SERVICE_TYPE, listener=listener)
-        
-        while not threading.current_thread().stop_event.is_set():
-            time.sleep(0.5) # Check stop event periodically
-            # ServiceBrowser does its work in its own internal threads managed by Zeroconf
+        _mdns_loop = asyncio.get_running_loop()
+        _mdns_wake_event = asyncio.Event()
+        if on_loop_change:
+            on_loop_change(_mdns_loop) # Let other app components schedule work on this loop
 
-    except Exception as e:
-        logger.error(f"mDNS Thread: Unhandled exception: {e}", exc_info=True)
+        logger.info("mDNS Thread: Resolving '%s'...", ESP32_SERVICE_NAME)
+        retry_delay = RESOLVE_RETRY_MIN_S
+        # Shutdown may have been requested before the wake event existed, so check first
+        while not stop_event.is_set():
+            bypass_cache, _mdns_refresh_requested = _mdns_refresh_requested, False
+            ttl_s = await resolver.async_resolve(aiozc.zeroconf, bypass_cache)
+            if ttl_s is not None:
+                retry_delay = RESOLVE_RETRY_MIN_S
+                # Small positive jitter so the refresh lands after the records expire
+                delay = max(ttl_s, RESOLVE_REFRESH_MIN_S) + random.uniform(0, RESOLVE_REFRESH_MIN_S)
+            else:
+                delay = _jittered(retry_delay)
+                retry_delay = min(retry_delay * 2, RESOLVE_RETRY_MAX_S)
+            try:
+                await asyncio.wait_for(_mdns_wake_event.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            _mdns_wake_event.clear()
     finally:
         logger.info("mDNS Thread: Exiting and cleaning up Zeroconf resources.")
-        if _browser_instance_thread:
-            try: _browser_instance_thread.cancel()
-            except: pass
-        if _zc_instance_thread:
-            try: _zc_instance_thread.close()
-            except: pass
-        _zc_instance_thread = None
-        _browser_instance_thread = None
\ No newline at end of file
+        if on_loop_change:
+            on_loop_change(None)
+        try: await aiozc.async_close()
+        except Exception: pass
+        _mdns_loop = None
+        _mdns_wake_event = None
+
+def wake_mdns_thread(refresh=False):
+    """
+    Wakes the mDNS thread's event loop so it re-checks its stop event and, if still
+    running, re-resolves the ESP32 right away. With refresh, that resolve skips the
+    cached records and queries the network. Thread-safe.
+    """
+    global _mdns_refresh_requested
+    loop, wake_event = _mdns_loop, _mdns_wake_event
+    if loop is not None and wake_event is not None:
+        if refresh:
+            _mdns_refresh_requested = True # Read by the loop after the wake below
+        try:
+            loop.call_soon_threadsafe(wake_event.set)
+        except RuntimeError: # Loop already closed
+            pass
+
+def mdns_browser_thread_target_stoppable(stop_event, service_info_dict_ref, service_info_lock_ref,
+                                         service_snapshot_ref, on_loop_change=None):
+    """
+    Runs the app's background event loop: mDNS resolution, plus any work other
+    components schedule on it. on_loop_change(loop) is called once the loop is
+    running and on_loop_change(None) when it is about to exit.
+    """
+    try:
+        # Keep mDNS packet handling off the cores serving capture requests
+        if pin_current_thread_to_cores(MDNS_CPU_CORES):
+            logger.info("mDNS Thread: Pinned to CPU cores %s.", sorted(MDNS_CPU_CORES))
+        resolver = ESP32Resolver(ESP32_SERVICE_NAME, service_info_dict_ref, service_info_lock_ref,
+                                 service_snapshot_ref)
+        # Zeroconf and the resolve loop share this thread's event loop
+        asyncio.run(_async_resolve_until_stopped(stop_event, resolver, on_loop_change))
+    except Exception as e:
+        logger.error(f"mDNS Thread: Unhandled exception: {e}", exc_info=True)
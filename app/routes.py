@@ -1,148 +1,287 @@
 # app/routes.py
 import os
-from flask import request, jsonify, render_template, send_from_directory # Changed to render_template
+import hashlib
+import json
+import mimetypes
+import random
+import shutil
+import threading
+import urllib3
+from flask import request, jsonify, render_template, send_from_directory, Response, abort # Changed to render_template
+from werkzeug.security import safe_join
 import logging
-from datetime import datetime # Keep for creating the datetime object
-# datetime and time are not directly used in routes if utils.py handles timestamp
-# but keep if other logic needs them here.
+import time # time.time_ns() timestamps for the capture log
 
 # Import the app instance and shared data/locks from app package's __init__.py
 from app import app_flask_instance, esp32_service_info, esp32_service_info_lock, \
-                rpi_image_id_counter, rpi_image_id_counter_lock, log_manager
+                esp32_service_snapshot, next_rpi_image_id, upload_dir_fd, log_manager
 
 # Import functions from our new modules
-from app.camera_comms import fetch_image_from_esp32
-from app.utils import get_formatted_timestamp # Assuming you created app/utils.py
+from app.camera_comms import fetch_image_from_esp32, reset_esp32_connections
+from app.utils import CAPTURE_FILENAME_PREFIX # Assuming you created app/utils.py
+from app.config import ESP32_MDNS_HOSTNAME_BASE
+from app.mdns_discover import wake_mdns_thread
 
 logger = logging.getLogger(__name__)
 
+STREAM_CHUNK_SIZE = 64 * 1024 # Bytes copied per read when streaming an image to disk
+JPEG_SOI_MARKER = b'\xff\xd8' # Every JPEG stream starts with the Start Of Image marker
+# Captures are flushed to storage in batches: at most this many can be lost on power failure
+CAPTURE_SYNC_EVERY = 8
+# Descriptors of the captures written since the last batch sync, kept open until then
+_unsynced_capture_fds = []
+_unsynced_capture_fds_lock = threading.Lock()
+_fdatasync = getattr(os, "fdatasync", os.fsync) # fdatasync is Linux/Unix only
+UPLOAD_CACHE_MAX_AGE_S = 60 # Cache-Control max-age for served captures
+# A 502 (connection refused/reset, connect timeout, body cut off or empty) is tried this
+# many times in total, backing off 50 ms, 100 ms, ... plus up to 50 ms jitter, before the
+# ESP32's address is dropped. A dead ESP32 thus costs up to ~3 s (1 s connect timeout each).
+FETCH_ATTEMPTS_ON_502 = 3
+FETCH_RETRY_BASE_DELAY_S = 0.05
+
+# Constant JSON bodies for the "ESP32 not discovered" responses, serialized once at import
+_NOT_DISCOVERED_BODY = json.dumps(
+    {"status": "not_discovered", "target_hostname": f"{ESP32_MDNS_HOSTNAME_BASE}.local"}).encode()
+_NOT_DISCOVERED_503_BODY = json.dumps(
+    {"status": "error", "message": "ESP32 service not discovered. Please wait or check ESP32."}).encode()
+
+_index_html = None # index.html rendered once; its inputs are constant
+
+STATUS_CACHE_TTL_S = 2.0 # Also sent as max-age, so pollers reuse it without asking
+# Last /esp32-status body and its ETag. Rebuilt when the TTL lapses or the published
+# snapshot changes; replaced wholesale so concurrent requests never see a mix.
+_status_cache = {"snapshot": None, "body": _NOT_DISCOVERED_BODY, "etag": "", "stamp": 0.0}
+
 @app_flask_instance.route('/')
 def index():
-    # Import ESP32_MDNS_HOSTNAME_BASE from mdns_discover to pass to template
-    # This ensures we always get the current config if it were to change (though it's const here)
-    from app.mdns_discover import ESP32_MDNS_HOSTNAME_BASE
-    return render_template('index.html', 
-                           target_mdns_hostname=ESP32_MDNS_HOSTNAME_BASE,
-                           target_mdns_hostname_for_js=ESP32_MDNS_HOSTNAME_BASE) # For JS access
+    global _index_html
+    if _index_html is None:
+        # Rendered on first request (url_for needs a request context), then served as bytes
+        _index_html = render_template('index.html',
+                                      target_mdns_hostname=ESP32_MDNS_HOSTNAME_BASE,
+                                      target_mdns_hostname_for_js=ESP32_MDNS_HOSTNAME_BASE).encode('utf-8') # For JS access
+    return Response(_index_html, mimetype='text/html')
 
 @app_flask_instance.route('/uploads/<filename>')
 def display_image(filename):
+    accel_prefix = app_flask_instance.config['X_ACCEL_REDIRECT_PREFIX']
+    if accel_prefix:
+        # Behind nginx: hand the file back to nginx, which sendfile()s it from disk
+        internal_path = safe_join(accel_prefix, filename)
+        if internal_path is None:
+            abort(404)
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = internal_path
+        response.cache_control.public = True
+        response.cache_control.max_age = UPLOAD_CACHE_MAX_AGE_S
+        return response
+
+    # Fallback for the Werkzeug dev server / plain gunicorn.
     # app_flask_instance.config['UPLOAD_FOLDER'] is set in app/__init__.py
-    return send_from_directory(app_flask_instance.config['UPLOAD_FOLDER'], filename)
+    # conditional=True answers repeat loads with 304 via ETag/Last-Modified; full sends
+    # go through the WSGI server's file wrapper (sendfile) or X-Sendfile if enabled.
+    # Capture filenames are unique and never rewritten, so browsers may cache them.
+    # Passing max_age makes werkzeug send "public, max-age=..." instead of its default no-cache.
+    return send_from_directory(app_flask_instance.config['UPLOAD_FOLDER'], filename,
+                               conditional=True, max_age=UPLOAD_CACHE_MAX_AGE_S)
 
 @app_flask_instance.route('/esp32-status')
 def esp32_status_route():
-    url = None # Default to None
-    with esp32_service_info_lock:
-        url = esp32_service_info.get("url")
-    
-    if url:
-        return jsonify({"status": "discovered", "url": url})
+    global _status_cache
+    snapshot = esp32_service_snapshot[0] # Lock-free read of the published tuple
+    cache = _status_cache
+    now = time.monotonic()
+
+    if cache["snapshot"] is not snapshot or now - cache["stamp"] >= STATUS_CACHE_TTL_S:
+        if snapshot:
+            # url is always "http://<ip>:<port>/capture", so it needs no JSON escaping
+            body = f'{{"status": "discovered", "url": "{snapshot[0]}"}}'.encode()
+        else:
+            body = _NOT_DISCOVERED_BODY
+        cache = {"snapshot": snapshot, "body": body,
+                 "etag": hashlib.blake2b(body, digest_size=8).hexdigest(), "stamp": now}
+        _status_cache = cache
+
+    # Pollers that already hold this body get an empty 304 instead
+    if request.if_none_match.contains(cache["etag"]):
+        response = Response(status=304)
     else:
-        from app.mdns_discover import ESP32_MDNS_HOSTNAME_BASE # Import if needed for target name
-        return jsonify({"status": "not_discovered", "target_hostname": f"{ESP32_MDNS_HOSTNAME_BASE}.local"})
+        response = Response(cache["body"], mimetype='application/json')
+    response.set_etag(cache["etag"])
+    response.cache_control.max_age = int(STATUS_CACHE_TTL_S)
+    return response
+
+
+def _stream_error_status(error):
+    """504 for a read timeout while receiving the body, 502 for any other connection failure."""
+    return 504 if isinstance(error, urllib3.exceptions.TimeoutError) else 502
+
+def _discard_partial_capture(filepath, dir_fd):
+    """Removes a capture file whose body never arrived completely, so it is never served."""
+    try:
+        os.unlink(filepath, dir_fd=dir_fd)
+    except OSError as e:
+        logger.error(f"Could not remove partial capture {filepath}: {e}")
+
+def _queue_capture_sync(fd):
+    """
+    Takes ownership of a written capture's descriptor. Every CAPTURE_SYNC_EVERY captures,
+    the batch is flushed to storage: fdatasync on each of those files, then fsync on the
+    upload folder for their directory entries. Unlike os.sync() this touches nothing else
+    (other processes, the CSV log). The captures are already saved, so failures are only logged.
+    """
+    with _unsynced_capture_fds_lock:
+        _unsynced_capture_fds.append(fd)
+        if len(_unsynced_capture_fds) < CAPTURE_SYNC_EVERY:
+            return
+        batch = _unsynced_capture_fds[:]
+        _unsynced_capture_fds.clear()
+
+    for batch_fd in batch:
+        try:
+            _fdatasync(batch_fd)
+        except OSError as e:
+            logger.error(f"Error syncing a capture to storage: {e}")
+        finally:
+            os.close(batch_fd)
+    if upload_dir_fd is not None:
+        try:
+            os.fsync(upload_dir_fd)
+        except OSError as e:
+            logger.error(f"Error syncing the upload folder to storage: {e}")
 
+def _receive_capture(esp_response, rpi_image_id, content_type):
+    """
+    Streams the body of a successful ESP32 response into a new capture file.
+    Returns (saved_filename, is_jpeg, image_size_bytes, error_message, status_code).
+    On failure no file is left behind and saved_filename is N/A_ERROR (the ESP32 side
+    failed: 502/504, retried like a failed request) or N/A_SAVE_ERROR (500).
+    """
+    # Expecting JPEG from OV2640. Detect it from the JPEG SOI marker at the start of the
+    # body rather than trusting the Content-Type header, which may be missing or wrong.
+    try:
+        prefix = esp_response.raw.read(len(JPEG_SOI_MARKER))
+    except Exception as e:
+        logger.error(f"Error reading image data from ESP32: {e}")
+        return "N/A_ERROR", False, 0, "Failed to read image data from ESP32", _stream_error_status(e)
+    if not prefix:
+        logger.error("ESP32 returned empty image data.")
+        return "N/A_ERROR", False, 0, "ESP32 returned empty image data", 502
+
+    is_jpeg = prefix == JPEG_SOI_MARKER
+    if is_jpeg:
+        saved_filename = f"{CAPTURE_FILENAME_PREFIX}{rpi_image_id:08d}.jpg"
+    else:
+        # This case should ideally not happen if ESP32 is configured for JPEG
+        logger.warning(f"ESP32 data is not a JPEG (no SOI marker, Content-Type: {content_type}).")
+        saved_filename = f"{CAPTURE_FILENAME_PREFIX}{rpi_image_id:08d}.bin" # Save with ID
+    if upload_dir_fd is not None:
+        filepath, dir_fd = saved_filename, upload_dir_fd # Resolved relative to the open folder
+    else:
+        filepath, dir_fd = os.path.join(app_flask_instance.config['UPLOAD_FOLDER'], saved_filename), None
+
+    try:
+        # O_EXCL: a capture is never silently overwritten, whatever the ID counter says
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644, dir_fd=dir_fd)
+    except OSError as e:
+        logger.error(f"Error creating image file {saved_filename}: {e}")
+        return "N/A_SAVE_ERROR", is_jpeg, 0, f"Failed to save image on RPi: {e}", 500
+
+    try:
+        # Stream the body straight from the socket to disk; the image is never held in memory whole.
+        # Buffered on purpose: BufferedWriter hands chunks larger than its buffer straight to
+        # write(2), and unlike a raw FileIO it retries short writes and raises when the disk is full.
+        with os.fdopen(fd, 'wb', closefd=False) as f: # fd stays open for the batch sync
+            f.write(prefix)
+            shutil.copyfileobj(esp_response.raw, f, STREAM_CHUNK_SIZE)
+            image_size_bytes = f.tell()
+    except urllib3.exceptions.HTTPError as e: # Connection dropped or timed out mid-body
+        logger.error(f"ESP32 connection failed while receiving {saved_filename}: {e}")
+        os.close(fd)
+        _discard_partial_capture(filepath, dir_fd)
+        status_code = _stream_error_status(e)
+        message = ("Timeout: ESP32 stopped sending image data." if status_code == 504
+                   else "Connection to ESP32 lost while receiving image data.")
+        return "N/A_ERROR", is_jpeg, 0, message, status_code
+    except Exception as e:
+        logger.error(f"Error saving image {saved_filename}: {e}", exc_info=True)
+        os.close(fd)
+        _discard_partial_capture(filepath, dir_fd)
+        return "N/A_SAVE_ERROR", is_jpeg, 0, f"Failed to save image on RPi: {e}", 500
+
+    _queue_capture_sync(fd)
+    return saved_filename, is_jpeg, image_size_bytes, None, 200
 
 @app_flask_instance.route('/trigger-esp32-capture', methods=['POST'])
 def handle_trigger_capture():
-    # Access shared counter via the import from app package
-    global rpi_image_id_counter 
+    snapshot = esp32_service_snapshot[0] # Lock-free read of the published tuple
+    current_capture_url = snapshot[0] if snapshot else None
 
-    current_capture_url = None
-    with esp32_service_info_lock:
-        current_capture_url = esp32_service_info.get("url")
-
-    logger.info(f"Trigger request. Current known ESP32 URL: {current_capture_url}")
+    logger.info("Trigger request. Current known ESP32 URL: %s", current_capture_url)
 
     if not current_capture_url:
         logger.error("ESP32 Capture URL not currently known (mDNS discovery pending/failed).")
-        return jsonify({"status": "error", "message": "ESP32 service not discovered. Please wait or check ESP32."}), 503
+        return Response(_NOT_DISCOVERED_503_BODY, status=503, mimetype='application/json')
 
-    image_data, content_type, error_msg, status_code, fetch_time_ms = \
-        fetch_image_from_esp32(current_capture_url)
+    current_rpi_id_val = None # Assigned once a response arrives; a retry after a failed body reuses it
+    for attempt in range(FETCH_ATTEMPTS_ON_502):
+        esp_response, content_type, error_msg, status_code, fetch_time_ms = \
+            fetch_image_from_esp32(current_capture_url)
+        if error_msg:
+            saved_filename, image_size_bytes = "N/A_ERROR", 0
+        else:
+            # --- RPi-side Timestamp and ID ---
+            # The image ID names the file; the timestamp is only needed for the CSV log,
+            # which formats it off the request path
+            rpi_timestamp_ns = time.time_ns()
+            if current_rpi_id_val is None:
+                current_rpi_id_val = next_rpi_image_id()
+            with esp_response:
+                saved_filename, is_jpeg, image_size_bytes, error_msg, status_code = \
+                    _receive_capture(esp_response, current_rpi_id_val, content_type)
+        # Only 502s are retried, connect timeouts included: a brief Wi-Fi hiccup shouldn't
+        # cost an mDNS round trip. Read timeouts (504) and ESP32 HTTP errors are not.
+        if status_code != 502 or attempt == FETCH_ATTEMPTS_ON_502 - 1:
+            break
+        time.sleep(FETCH_RETRY_BASE_DELAY_S * (2 ** attempt) + random.uniform(0, FETCH_RETRY_BASE_DELAY_S))
 
     if error_msg:
-        # If connection error, clear the cached URL to encourage re-discovery by mDNS listener
+        # If the connection still fails, mark the cached URL stale and re-resolve it right away
         if status_code == 502: # HTTP 502 Bad Gateway often means connection issue
-            logger.warning("Connection error to ESP32. Clearing cached URL to trigger mDNS re-check.")
+            logger.warning(f"ESP32 still failing (502) after {FETCH_ATTEMPTS_ON_502} attempts. "
+                           "Clearing cached URL and re-resolving via mDNS.")
             with esp32_service_info_lock:
                 esp32_service_info["url"] = None
                 esp32_service_info["ip"] = None
                 esp32_service_info["port"] = None
+                esp32_service_snapshot[0] = None
+            reset_esp32_connections() # Don't reuse a socket to the old address
+            wake_mdns_thread(refresh=True) # Unicast query now; the cached address just failed
         # Log the failure event before returning
         log_manager.log_capture_event(
-            rpi_datetime_obj=datetime.now(), # Timestamp of the failure event
-            rpi_image_id=0, # Or a special ID for failures, or None if func handles it
-            saved_filename="N/A_ERROR",
-            image_size_bytes=0,
+            rpi_timestamp_ns=time.time_ns(), # Timestamp of the failure event
+            rpi_image_id=current_rpi_id_val or 0, # 0 if the ESP32 never answered
+            saved_filename=saved_filename, # N/A_ERROR or N/A_SAVE_ERROR
+            image_size_bytes=image_size_bytes,
             fetch_duration_ms=fetch_time_ms if fetch_time_ms is not None else 0,
             esp32_url_used=current_capture_url if current_capture_url else "N/A_NO_URL",
         )
         return jsonify({"status": "error", "message": error_msg}), status_code
 
-    # --- RPi-side Timestamp and ID ---
-    rpi_dt_obj_for_log_and_filename = datetime.now() # Get timestamp ONCE for consistency
-    rpi_filename_ts_str = rpi_dt_obj_for_log_and_filename.strftime('%Y%m%d_%H%M%S_%f') # For filename
-    
-    current_rpi_id_val = 0
-    with rpi_image_id_counter_lock:
-        rpi_image_id_counter += 1
-        current_rpi_id_val = rpi_image_id_counter
-    
-    # --- Image Saving and Response ---
-    # Expecting JPEG from OV2640
-    if 'image/jpeg' in content_type:
-        saved_filename = f"image_{rpi_filename_ts_str}_{current_rpi_id_val}.jpg"
-        filepath = os.path.join(app_flask_instance.config['UPLOAD_FOLDER'], saved_filename)
-        try:
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
-            logger.info(f"OV2640 JPEG image saved as {filepath}")
-            
-            # --- Call the logging function ---
-            log_manager.log_capture_event(
-                rpi_datetime_obj=rpi_dt_obj_for_log_and_filename, # Pass the datetime object
-                rpi_image_id=current_rpi_id_val,
-                saved_filename=saved_filename,
-                image_size_bytes=len(image_data),
-                fetch_duration_ms=fetch_time_ms,
-                esp32_url_used=current_capture_url
-            )
-            # --- End logging call ---
-
-            return jsonify({"status": "success", "filename": saved_filename, "message": "OV2640 JPEG captured and saved."})
-        except Exception as e:
-            logger.error(f"Error saving image {saved_filename}: {e}", exc_info=True)
-            # Log this failure too
-            log_manager.log_capture_event(
-                rpi_datetime_obj=rpi_dt_obj_for_log_and_filename,
-                rpi_image_id=current_rpi_id_val, # ID was generated
-                saved_filename="N/A_SAVE_ERROR",
-                image_size_bytes=len(image_data) if image_data else 0,
-                fetch_duration_ms=fetch_time_ms,
-                esp32_url_used=current_capture_url,
-            )
-            return jsonify({"status": "error", "message": f"Failed to save image on RPi: {e}"}), 500
-    else:
-        # This case should ideally not happen if ESP32 is configured for JPEG
-        logger.warning(f"Unexpected Content-Type from ESP32: {content_type}. Expected 'image/jpeg'.")
-        saved_filename = f"image_{rpi_filename_ts_str}_{current_rpi_id_val}_unknown_type.bin" # Save with ID/TS
-        filepath = os.path.join(app_flask_instance.config['UPLOAD_FOLDER'], saved_filename)
-        try:
-            with open(filepath, 'wb') as f:
-                f.write(image_data)
-            logger.info(f"Raw data (unexpected type) saved as {filepath}")
-            # Log this event as well, noting the unexpected type
-            log_manager.log_capture_event(
-                rpi_datetime_obj=rpi_dt_obj_for_log_and_filename,
-                rpi_image_id=current_rpi_id_val,
-                saved_filename=saved_filename,
-                image_size_bytes=len(image_data),
-                fetch_duration_ms=fetch_time_ms,
-                esp32_url_used=current_capture_url,
-            )
-            return jsonify({"status": "error", 
-                            "message": f"Unexpected content type '{content_type}' from ESP32. Raw data saved as .bin."}), 415 # Unsupported Media Type
-        except Exception as e:
-            logger.error(f"Error saving raw data {saved_filename}: {e}", exc_info=True)
-            return jsonify({"status": "error", "message": f"Failed to save raw image data: {e}"}), 500
\ No newline at end of file
+    # --- Call the logging function ---
+    log_manager.log_capture_event(
+        rpi_timestamp_ns=rpi_timestamp_ns,
+        rpi_image_id=current_rpi_id_val,
+        saved_filename=saved_filename,
+        image_size_bytes=image_size_bytes,
+        fetch_duration_ms=fetch_time_ms,
+        esp32_url_used=current_capture_url
+    )
+    # --- End logging call ---
+
+    if is_jpeg:
+        logger.info("OV2640 JPEG image (%d bytes) saved as %s", image_size_bytes, saved_filename)
+        return jsonify({"status": "success", "filename": saved_filename, "message": "OV2640 JPEG captured and saved."})
+    logger.info("Raw data (unexpected type, %d bytes) saved as %s", image_size_bytes, saved_filename)
+    return jsonify({"status": "error",
+                    "message": f"ESP32 data is not a JPEG (Content-Type '{content_type}'). Raw data saved as .bin."}), 415 # Unsupported Media Type
@@ -1,8 +1,47 @@
 # app/utils.py
+import os
+import re
 from datetime import datetime
 
-def get_formatted_timestamp():
-    """Returns a string timestamp like YYYYMMDD_HHMMSS_ffffff"""
-    return datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+# CPU placement on the Pi 5 (4 cores): the mDNS/background loop thread is bursty but
+# latency-insensitive, so it gets core 0 and the latency-sensitive request threads keep
+# cores 1-3 to themselves.
+MDNS_CPU_CORES = {0}
+APP_CPU_CORES = {1, 2, 3}
 
-# You can add other helper functions here later
\ No newline at end of file
+# Captures are saved as cap_<8-digit RPi image ID>.jpg (or .bin)
+CAPTURE_FILENAME_PREFIX = "cap_"
+_CAPTURE_FILENAME_RE = re.compile(rf"^{CAPTURE_FILENAME_PREFIX}(\d+)\.")
+
+def iso_timestamp_from_ns(timestamp_ns):
+    """Returns the local-time ISO 8601 string for a time.time_ns() value, like datetime.now().isoformat()"""
+    seconds, micros = divmod(timestamp_ns // 1000, 1_000_000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=micros).isoformat()
+
+def find_last_capture_id(upload_folder):
+    """
+    Returns the highest image ID among saved captures in upload_folder (0 if none),
+    so IDs, and therefore filenames, keep increasing across restarts.
+    """
+    last_id = 0
+    with os.scandir(upload_folder) as entries:
+        for entry in entries:
+            match = _CAPTURE_FILENAME_RE.match(entry.name)
+            if match:
+                last_id = max(last_id, int(match.group(1)))
+    return last_id
+
+# You can add other helper functions here later
+
+def pin_current_thread_to_cores(cores):
+    """
+    Restricts the calling thread (and threads it creates afterwards) to `cores`.
+    Linux-only; a no-op returning False on other platforms or smaller CPUs.
+    """
+    if not hasattr(os, "sched_setaffinity") or (os.cpu_count() or 0) <= max(cores):
+        return False
+    try:
+        os.sched_setaffinity(0, cores) # pid 0 = the calling thread on Linux
+        return True
+    except OSError:
+        return False
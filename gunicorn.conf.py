@@ -0,0 +1,30 @@
+# gunicorn.conf.py
+# Used by: gunicorn -c gunicorn.conf.py wsgi:application
+
+bind = "0.0.0.0:5000"
+# One process only: ESP32 discovery state, the image ID counter and the CSV log are
+# per-process. Concurrency comes from threads instead.
+workers = 1
+worker_class = "gthread"
+threads = 4
+# Never load the app in the master. The app package is first imported by post_fork,
+# so every worker, including one respawned after a crash, seeds its image ID counter
+# from the captures on disk at that moment and opens its own log file. A preloaded
+# app would make respawned workers reissue IDs and overwrite existing captures.
+preload_app = False
+
+
+def post_fork(server, worker):
+    # Start mDNS discovery inside the worker so exactly one thread runs, in the
+    # process that serves requests (never in the master). This is also where the
+    # worker first imports the app (see preload_app above).
+    from app import start_mdns_thread
+    from app.utils import APP_CPU_CORES, pin_current_thread_to_cores
+    # Request threads inherit this mask; the mDNS thread moves itself to its own core
+    pin_current_thread_to_cores(APP_CPU_CORES)
+    start_mdns_thread()
+
+
+def worker_exit(server, worker):
+    from app import shutdown_app_resources
+    shutdown_app_resources()
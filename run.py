@@ -1,41 +1,91 @@
 # run.py
+import importlib.util
+import os
 import signal
 import sys
 import logging # Add logging import for run.py itself
 
-# Import the functions from the app package's __init__.py
-from app import start_mdns_and_app_thread_safe, shutdown_app_resources, logger as app_logger 
+# The app package is imported lazily, only on the development-server path. Under
+# gunicorn the master must never load it: a respawned worker would inherit the
+# master's image ID counter and log file from before the first fork, and reissue IDs
+# (overwriting captures) that an earlier worker already used.
 
-# Configure logging for run.py if needed, or rely on app's config
+# Rely on the root logger configured by the app package. Adding a handler here as
+# well would emit every run.py record twice (once here, once via propagation).
 logger = logging.getLogger("run_script") # Specific logger for this script
-if not logger.handlers: # Avoid duplicate handlers if app already configured root logger
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.INFO)
+
+GUNICORN_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+
+
+def run_with_gunicorn():
+    """
+    Serves the app with gunicorn in-process, using the settings and hooks in
+    gunicorn.conf.py (the mDNS thread is started by its post_fork hook and cleaned
+    up by worker_exit). Returns False without serving if gunicorn isn't installed.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        return False
+
+    class GunicornApp(BaseApplication):
+        def load_config(self):
+            spec = importlib.util.spec_from_file_location("gunicorn_conf", GUNICORN_CONFIG_PATH)
+            conf = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(conf)
+            for key, value in vars(conf).items():
+                if key in self.cfg.settings:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            from wsgi import application
+            return application
+
+    GunicornApp().run() # Installs its own signal handling in the master process
+    return True
 
 
 def signal_handler(sig, frame):
-    logger.info(f'Received signal {sig}, initiating graceful shutdown...')
+    from app import shutdown_app_resources
+    logger.info('Received signal %s, initiating graceful shutdown...', sig)
     shutdown_app_resources() # Call the cleanup function from app package
     sys.exit(0)
 
-if __name__ == '__main__':
+
+def run_dev_server():
+    """Fallback without gunicorn: the mDNS thread plus Flask's development server, in this process."""
+    # Import the functions from the app package's __init__.py
+    from app import start_mdns_and_app_thread_safe
+    from app.utils import APP_CPU_CORES, pin_current_thread_to_cores
+
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)  # Ctrl+C
     signal.signal(signal.SIGTERM, signal_handler) # kill command
 
     logger.info("Application starting via run.py...")
+    logger.warning("gunicorn is not installed; falling back to Flask's development server.")
+    # Flask's request threads inherit this mask; the mDNS thread moves itself to its own core
+    if pin_current_thread_to_cores(APP_CPU_CORES):
+        logger.info("Pinned application threads to CPU cores %s.", sorted(APP_CPU_CORES))
+    # Call the function from app package to start everything
+    start_mdns_and_app_thread_safe(host='0.0.0.0', port=5000, debug=False)
+
+if __name__ == '__main__':
+    # Outside the try below: gunicorn exits through SystemExit in both the master and its
+    # forked workers, and its exit codes (e.g. 3 when a worker fails to boot) must reach
+    # the caller and the arbiter unchanged.
+    if run_with_gunicorn():
+        sys.exit(0)
     try:
-        # Call the function from app package to start everything
-        start_mdns_and_app_thread_safe(host='0.0.0.0', port=5000, debug=False)
+        run_dev_server()
     except SystemExit:
         logger.info("Application exited via SystemExit (likely from signal handler).")
     except Exception as e:
         logger.error(f"Unhandled exception in run.py during app execution: {e}", exc_info=True)
         # Ensure cleanup is attempted even on unexpected error during startup/run
-        shutdown_app_resources() 
+        if 'app' in sys.modules:
+            from app import shutdown_app_resources
+            shutdown_app_resources()
     finally:
         # This finally block in run.py itself is for run.py's own lifecycle.
         # The actual app resource cleanup (like mDNS thread) should be handled by shutdown_app_resources.
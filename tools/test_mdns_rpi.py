@@ -1,27 +1,52 @@
 
+import sys
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from zeroconf import ServiceBrowser, Zeroconf
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# get_service_info blocks for up to its timeout. Resolve on worker threads so the
+# browser's dispatch thread keeps processing other services in the meantime.
+resolve_executor = ThreadPoolExecutor(max_workers=2)
+
 class SimpleListener:
+    def __init__(self, name_filter=None):
+        # Optional lowercase substring; services whose name lacks it are never resolved
+        self.name_filter = name_filter.lower() if name_filter else None
+
+    def _wanted(self, name):
+        return self.name_filter is None or self.name_filter in name.lower()
+
     def remove_service(self, zeroconf, type, name):
+        if not self._wanted(name):
+            return
         logging.info(f"Service {name} removed")
 
     def add_service(self, zeroconf, type, name):
+        if not self._wanted(name):
+            logging.debug(f"Service {name} seen, skipped (no '{self.name_filter}' in name)")
+            return
+        resolve_executor.submit(self._resolve_and_log, zeroconf, type, name)
+
+    def _resolve_and_log(self, zeroconf, type, name):
         info = zeroconf.get_service_info(type, name)
         logging.info(f"Service {name} ADDED, info: {info}")
     
     def update_service(self, zeroconf, type, name): # Add this
+        if not self._wanted(name):
+            return
         logging.debug(f"Service {name} updated.")
         # You could try get_service_info again here if needed
         # info = zeroconf.get_service_info(type, name)
         # logging.info(f"Service {name} UPDATED, info: {info}")
 
 
+# Usage: python tools/test_mdns_rpi.py [name-substring]
+# e.g. "my-esp32-cam" to resolve only the ESP32 instead of every HTTP device on the LAN
 zc = Zeroconf()
-listener = SimpleListener()
+listener = SimpleListener(sys.argv[1] if len(sys.argv) > 1 else None)
 # Use the same service type your ESP32 is advertising
 browser = ServiceBrowser(zc, "_http._tcp.local.", listener)
 logging.info("Browsing for _http._tcp.local. services for 60 seconds...")
@@ -32,4 +57,6 @@ except KeyboardInterrupt:
     pass
 finally:
     logging.info("Closing zeroconf...")
+    browser.cancel()
+    resolve_executor.shutdown(wait=True) # Let in-flight resolves finish before closing
     zc.close()
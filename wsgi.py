@@ -0,0 +1,12 @@
+# wsgi.py
+# Production entry point. Run with the settings in gunicorn.conf.py:
+#
+#     gunicorn -c gunicorn.conf.py wsgi:application
+#
+# i.e. one gthread worker with 4 threads on 0.0.0.0:5000, so /esp32-status polls
+# are served while a capture is in progress. Keep a single worker: the mDNS state,
+# image ID counter and CSV log live in-process. The mDNS thread is started by the
+# post_fork hook, not on import.
+from app import app_flask_instance
+
+application = app_flask_instance